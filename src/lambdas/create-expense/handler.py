@@ -1,25 +1,50 @@
-import json
 import boto3
+import orjson
 import uuid
 import os
-from datetime import datetime
-from decimal import Decimal
-from typing import Dict, Any
+import time
+from datetime import date, datetime, timezone
+from decimal import Decimal, DecimalException
+from typing import Dict, Any, List
 import logging
 from botocore.exceptions import ClientError
+from boto3.dynamodb.types import DYNAMODB_CONTEXT, TypeSerializer
+
+try:
+    from snapshot_restore_py import register_before_snapshot
+except ImportError:
+    # Runtime hooks only exist on SnapStart-capable runtimes (Python 3.12+)
+    def register_before_snapshot(func):
+        return func
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Initialize AWS clients
-dynamodb = boto3.resource('dynamodb')
-s3_client = boto3.client('s3')
+dynamodb_client = boto3.client('dynamodb')
+serializer = TypeSerializer()
 
 # Environment variables
 TABLE_NAME = os.environ.get('EXPENSES_TABLE_NAME')
-S3_BUCKET = os.environ.get('EXPENSES_BUCKET_NAME')
-SIGNED_URL_EXPIRATION = int(os.environ.get('SIGNED_URL_EXPIRATION', '3600'))
+
+# BatchWriteItem accepts at most 25 put requests per call
+BATCH_WRITE_CHUNK_SIZE = 25
+BATCH_WRITE_MAX_ATTEMPTS = 6
+BATCH_WRITE_BASE_DELAY = 0.05  # seconds, doubled on every retry
+BATCH_WRITE_TIME_MARGIN = 0.5  # seconds kept free before the Lambda timeout to build the response
+MAX_BATCH_EXPENSES = 100
+
+# DynamoDB caps GSI key attributes at 1024 bytes (UTF-8)
+MERCHANT_NAME_KEY_MAX_BYTES = 1024
+
+# Response headers shared by every response; never mutated
+CORS_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
+    'Access-Control-Allow-Methods': 'POST,OPTIONS'
+}
 
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -39,100 +64,262 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     try:
         # Extract user ID, but not username from Cognito claims
-        print("EVENT:\n", event)
         user_id = get_user_id_from_event(event) or "darpankattel"
         if not user_id:
             return create_error_response(401, "Unauthorized: Invalid token")
 
         # Parse request body
-        body = json.loads(event.get('body', '{}'), parse_float=Decimal)
+        body = orjson.loads(event.get('body', '{}'))
+        if not isinstance(body, dict):
+            return create_error_response(400, "Request body must be a JSON object")
 
         # Validate required fields
         validation_error = validate_expense_data(body)
         if validation_error:
             return create_error_response(400, validation_error)
 
-        # Generate expense ID
-        expense_id = str(uuid.uuid4())
-        receipt_date = body['receipt_date']
-
         # Create expense record
-        expense_data = {
-            'PK': f'USER#{user_id}',
-            'SK': f'DATE#{receipt_date}#{expense_id}',
-            'userID': user_id,
-            'expenseID': expense_id,
-            'merchantName': body['merchant_name'],
-            'category': body.get('category', 'uncategorized'),
-            'amount': body['amount'],
-            'receiptDate': receipt_date,
-            'createdAt': datetime.now().isoformat(),
-        }
-        if body.get('others') is not None:
-            expense_data['others'] = body.get('others', {})
+        expense_data = build_expense_item(user_id, body, utc_now_iso())
+        expense_id = expense_data['expenseID']
 
         # Save to DynamoDB
-        table = dynamodb.Table(TABLE_NAME)
-        table.put_item(Item=expense_data)
+        dynamodb_client.put_item(
+            TableName=TABLE_NAME,
+            Item=serialize_item(expense_data)
+        )
 
         response_data = {
             'expenseId': expense_id,
             'message': 'Expense created successfully'
         }
 
-        logger.info(
-            f"Expense created successfully: {expense_id} for user: {user_id}")
+        logger.info("Expense created successfully: %s for user: %s", expense_id, user_id)
 
         return {
             'statusCode': 201,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-                'Access-Control-Allow-Methods': 'POST,OPTIONS'
-            },
-            'body': response_data
+            'headers': CORS_HEADERS,
+            'body': orjson.dumps(response_data).decode()
         }
 
     except ClientError as e:
-        logger.error(f"DynamoDB error: {str(e)}")
+        logger.error("DynamoDB error: %s", e)
         return create_error_response(500, "Database error occurred")
 
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         return create_error_response(400, "Invalid JSON in request body")
 
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
+        logger.error("Unexpected error: %s", e)
         return create_error_response(500, "Internal server error")
 
 
-def get_user_id_from_event(event: Dict[str, Any]) -> str:
+def lambda_handler_batch(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
-    Extract the immutable Cognito user ID ('sub') from API Gateway event.
-    This ID never changes for the lifetime of the user.
+    Batch Create Expenses Lambda Handler (POST /expenses/batch). Validates every expense up front,
+    then writes them with BatchWriteItem in chunks of 25.
+
+    Expected payload:
+    ```
+    {
+        "expenses": [
+            {"merchant_name": "Starbucks", "amount": 25.50, "receipt_date": "2025-01-15"},
+            {"merchant_name": "Bhatbhateni", "category": "Groceries", "amount": 540.75, "receipt_date": "2025-01-12"}
+        ]
+    }
+    ```
     """
     try:
-        # API Gateway REST API authorizer
-        if "requestContext" in event:
-            rc = event["requestContext"]
+        user_id = get_user_id_from_event(event) or "darpankattel"
+        if not user_id:
+            return create_error_response(401, "Unauthorized: Invalid token")
+
+        # Parse request body
+        body = orjson.loads(event.get('body', '{}'))
+        if not isinstance(body, dict):
+            return create_error_response(400, "Request body must be a JSON object")
+        expenses = body.get('expenses')
+        if not isinstance(expenses, list) or not expenses:
+            return create_error_response(400, "expenses must be a non-empty list")
+        if len(expenses) > MAX_BATCH_EXPENSES:
+            return create_error_response(400, f"Too many expenses (max {MAX_BATCH_EXPENSES} per request)")
+
+        # Validate everything before writing anything
+        for index, expense in enumerate(expenses):
+            if not isinstance(expense, dict):
+                return create_error_response(400, f"expenses[{index}]: Invalid expense object")
+            validation_error = validate_expense_data(expense)
+            if validation_error:
+                return create_error_response(400, f"expenses[{index}]: {validation_error}")
+
+        timestamp = utc_now_iso()
+        items = [serialize_item(build_expense_item(user_id, expense, timestamp)) for expense in expenses]
+        # Stop retrying before the function times out so the response can still report failures
+        deadline = None
+        if context is not None:
+            deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - BATCH_WRITE_TIME_MARGIN
+        unprocessed = batch_write_items(items, deadline)
+
+        failed_ids = {item['expenseID']['S'] for item in unprocessed}
+        response_data = {
+            'expenseIds': [item['expenseID']['S'] for item in items if item['expenseID']['S'] not in failed_ids],
+            'failedExpenseIds': sorted(failed_ids),
+            'message': 'Expenses created successfully' if not failed_ids else 'Some expenses could not be created'
+        }
 
-            # Newer HTTP API (JWT authorizer)
-            if "authorizer" in rc and "jwt" in rc["authorizer"]:
-                claims = rc["authorizer"]["jwt"].get("claims", {})
-                return claims.get("sub")
+        logger.info("Batch created %d/%d expenses for user: %s",
+                    len(items) - len(failed_ids), len(items), user_id)
 
-            # REST API (Cognito User Pool authorizer)
-            if "authorizer" in rc:
-                claims = rc["authorizer"].get("claims", {})
-                return claims.get("sub")
+        return {
+            'statusCode': 201 if not failed_ids else 207,
+            'headers': CORS_HEADERS,
+            'body': orjson.dumps(response_data).decode()
+        }
 
-        # If no ID available
-        return None
+    except ClientError as e:
+        logger.error("DynamoDB error: %s", e)
+        return create_error_response(500, "Database error occurred")
+
+    except orjson.JSONDecodeError:
+        return create_error_response(400, "Invalid JSON in request body")
 
     except Exception as e:
-        logger.error(f"Error extracting Cognito user ID: {e}")
+        logger.error("Unexpected error: %s", e)
+        return create_error_response(500, "Internal server error")
+
+
+def parse_amount(value: Any) -> Decimal:
+    """
+    Convert a request amount to the Decimal stored in DynamoDB.
+    Decimal via str() keeps the amount exactly as written, without float noise.
+    Raises ValueError for booleans, non-numbers, NaN/Infinity and values DynamoDB cannot store.
+    """
+    if isinstance(value, bool):
+        raise ValueError("Invalid amount")
+    try:
+        amount = Decimal(str(value))
+        if not amount.is_finite():
+            raise ValueError("Invalid amount")
+        # Same context TypeSerializer uses; traps precision loss and out-of-range exponents
+        DYNAMODB_CONTEXT.create_decimal(amount)
+    except DecimalException:
+        raise ValueError("Invalid amount")
+    return amount
+
+
+def floats_to_decimal(value: Any) -> Any:
+    """Recursively replace floats with Decimal, as DynamoDB does not accept float"""
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    if isinstance(value, dict):
+        return {k: floats_to_decimal(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [floats_to_decimal(v) for v in value]
+    return value
+
+
+def build_expense_item(user_id: str, data: Dict[str, Any], timestamp: str) -> Dict[str, Any]:
+    """Build the DynamoDB expense record for already validated expense data"""
+    expense_id = str(uuid.uuid4())
+    receipt_date = data['receipt_date']
+
+    expense_data = {
+        'PK': f'USER#{user_id}',
+        'SK': f'DATE#{receipt_date}#{expense_id}',
+        'userID': user_id,
+        'expenseID': expense_id,
+        'merchantName': data['merchant_name'],
+        # Sort key of UserMerchantIndex, used for case-insensitive prefix search
+        'merchantNameLower': merchant_name_key(data['merchant_name']),
+        'category': data.get('category') or 'uncategorized',
+        'amount': parse_amount(data['amount']),
+        'receiptDate': receipt_date,
+        'createdAt': timestamp,
+        'updatedAt': timestamp,
+    }
+    if data.get('others') is not None:
+        expense_data['others'] = floats_to_decimal(data['others'])
+
+    return expense_data
+
+
+def merchant_name_key(merchant_name: str) -> str:
+    """
+    Trimmed, lowercased merchant name for the UserMerchantIndex sort key, cut to at most
+    MERCHANT_NAME_KEY_MAX_BYTES of UTF-8 without splitting a character. A prefix still
+    matches begins_with searches.
+    """
+    encoded = merchant_name.strip().lower().encode('utf-8')
+    return encoded[:MERCHANT_NAME_KEY_MAX_BYTES].decode('utf-8', errors='ignore')
+
+
+def utc_now_iso() -> str:
+    """Current UTC time as an ISO timestamp (YYYY-MM-DDTHH:MM:SSZ)"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def serialize_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a plain Python item to low-level DynamoDB typed attribute values"""
+    return {k: serializer.serialize(v) for k, v in item.items()}
+
+
+def batch_write_items(items: List[Dict[str, Any]], deadline: float = None) -> List[Dict[str, Any]]:
+    """
+    Write serialized items using BatchWriteItem, 25 at a time.
+    UnprocessedItems are retried with exponential backoff until `deadline` (a time.monotonic()
+    value) would be exceeded. If a chunk fails with a ClientError, its pending items and all
+    later chunks are given up. Returns the items that were not written.
+    """
+    unprocessed = []
+    for start in range(0, len(items), BATCH_WRITE_CHUNK_SIZE):
+        if deadline is not None and time.monotonic() >= deadline:
+            unprocessed.extend(items[start:])
+            break
+
+        request_items = {
+            TABLE_NAME: [{'PutRequest': {'Item': item}} for item in items[start:start + BATCH_WRITE_CHUNK_SIZE]]
+        }
+        try:
+            for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+                if attempt:
+                    delay = BATCH_WRITE_BASE_DELAY * 2 ** (attempt - 1)
+                    if deadline is not None and time.monotonic() + delay >= deadline:
+                        break
+                    time.sleep(delay)
+                response = dynamodb_client.batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+                if not request_items:
+                    break
+        except ClientError as e:
+            logger.error("BatchWriteItem failed: %s", e)
+            unprocessed.extend(request['PutRequest']['Item'] for request in request_items[TABLE_NAME])
+            unprocessed.extend(items[start + BATCH_WRITE_CHUNK_SIZE:])
+            break
+
+        if request_items:
+            unprocessed.extend(request['PutRequest']['Item'] for request in request_items.get(TABLE_NAME, []))
+
+    if unprocessed:
+        logger.error("%d items left unprocessed", len(unprocessed))
+    return unprocessed
+
+
+def get_user_id_from_event(event: Dict[str, Any]) -> str:
+    """
+    Extract the immutable Cognito user ID ('sub') from API Gateway event.
+    This ID never changes for the lifetime of the user.
+    """
+    rc = event.get('requestContext')
+    if not rc:
+        return None
+    authorizer = rc.get('authorizer')
+    if not authorizer:
         return None
 
+    # Newer HTTP API (JWT authorizer) nests claims under 'jwt';
+    # REST API (Cognito User Pool authorizer) has them directly
+    claims = (authorizer.get('jwt') or authorizer).get('claims') or {}
+    return claims.get('sub')
+
 
 def validate_expense_data(data: Dict[str, Any]) -> str:
     """Validate expense data and return error message if invalid"""
@@ -142,54 +329,66 @@ def validate_expense_data(data: Dict[str, Any]) -> str:
         if field not in data or data[field] is None:
             return f"Missing required field: {field}"
 
-    # Validate amount
-    try:
-        amount = float(data['amount'])
-        if amount <= 0:
-            return "Amount must be greater than 0"
-        if amount > 9_99_999.99:
-            return "Amount too large"
-    except (ValueError, TypeError):
-        return "Invalid amount format"
-
-    # Validate receipt_date format (YYYY-MM-DD)
-    try:
-        datetime.strptime(data['receipt_date'], '%Y-%m-%d')
-    except ValueError:
-        return "Invalid receipt_date format. Use YYYY-MM-DD"
     # Validate merchant_name length
-    if len(data['merchant_name'].strip()) == 0:
-        return "Merchant cannot be empty"
-    if len(data['merchant_name']) > 500:
+    merchant_name = data['merchant_name']
+    if len(merchant_name) > 500:
         return "Merchant too long (max 500 characters)"
+    if not merchant_name.strip():
+        return "Merchant cannot be empty"
 
     # Validate category if provided
-    if 'category' in data and len(data['category']) > 100:
+    category = data.get('category')
+    if category is not None and len(category) > 100:
         return "Category too long (max 100 characters)"
 
+    # Validate receipt_date format (YYYY-MM-DD)
+    if not is_valid_date(data['receipt_date']):
+        return "Invalid receipt_date format. Use YYYY-MM-DD"
+
+    # Validate amount using the same conversion that is stored, so anything valid can be saved
+    try:
+        amount = parse_amount(data['amount'])
+    except ValueError:
+        return "Invalid amount format"
+    if amount <= 0:
+        return "Amount must be greater than 0"
+    if amount > Decimal('9_99_999.99'):
+        return "Amount too large"
+
     return None
 
 
+def is_valid_date(value: Any) -> bool:
+    """Check for a real calendar date in YYYY-MM-DD format without the overhead of datetime.strptime"""
+    if not isinstance(value, str) or len(value) != 10 or value[4] != '-' or value[7] != '-':
+        return False
+    year, month, day = value[:4], value[5:7], value[8:]
+    if not (year.isdigit() and month.isdigit() and day.isdigit()):
+        return False
+    try:
+        date(int(year), int(month), int(day))
+    except ValueError:
+        return False
+    return True
+
+
 def create_error_response(status_code: int, message: str) -> Dict[str, Any]:
     """Create standardized error response"""
     return {
         'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-            'Access-Control-Allow-Methods': 'POST,OPTIONS'
-        },
-        'body': {
+        'headers': CORS_HEADERS,
+        'body': orjson.dumps({
             'error': message,
             'statusCode': status_code
-        }
+        }).decode()
     }
 
 
-"""
-{
-  "body": "{\"merchant_name\": \"Starbucks\", \"category\": \"Food\", \"amount\": 25.5, \"receipt_date\": \"2025-01-15\", \"notes\": \"Coffee\"}"
-}
+@register_before_snapshot
+def warm_up_before_snapshot() -> None:
+    """Run the parse/validate/serialize path once so the SnapStart snapshot captures it warm"""
+    body = orjson.loads(
+        '{"merchant_name": "Snapshot", "amount": 1.5, "receipt_date": "2025-01-15", "others": {"notes": "warm-up"}}')
+    validate_expense_data(body)
+    serialize_item(build_expense_item('snapshot', body, utc_now_iso()))
 
-"""